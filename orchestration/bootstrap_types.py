@@ -1,6 +1,10 @@
+import bz2
 import logging
 import os
-from time import sleep
+import socket
+import tarfile
+import zlib
+from time import sleep, time
 from paramiko import SFTPClient
 
 # Logging boilerplate.
@@ -8,19 +12,47 @@ logger = logging.getLogger('bootstrap_types')
 
 class BootstrapTarError(Exception): pass
 
+class BootstrapTimeoutError(Exception): pass
+
 
 class BootstrapType(object):
 
     @staticmethod
-    def execute_command(command, client):
+    def remaining(deadline, what):
+        """
+        Seconds left before the deadline, or None if there is no deadline. Raises BootstrapTimeoutError if we
+        are already past it. Used to put timeouts on channels so that uploads can't hang forever either.
+        """
+        if deadline is None:
+            return None
+
+        left = deadline - time()
+        if left <= 0:
+            raise BootstrapTimeoutError, "Did not finish before the deadline: {0}.".format(what)
+
+        return left
+
+    @staticmethod
+    def wait_for_exit(chan, command, deadline):
+        """
+        Wait for the command on the channel to exit. If there is a deadline and we go past it then the channel
+        is closed, which takes the remote command down with it, and a BootstrapTimeoutError is raised.
+        """
+        while not chan.exit_status_ready():
+            if deadline is not None and time() > deadline:
+                chan.close()
+                raise BootstrapTimeoutError, "Command did not finish before the deadline: {0}.".format(command)
+            sleep(1)
+
+    @staticmethod
+    def execute_command(command, client, deadline=None):
         logger.info('Executing command: {0}.'.format(command))
         transport = client.get_transport()
         transport.set_keepalive(10)
         chan = transport.open_session()
         chan.get_pty(width=800, height=600)
         chan.exec_command(command)
-        while not chan.exit_status_ready():
-            sleep(1)
+        BootstrapType.wait_for_exit(chan, command, deadline)
 
         exit_status = chan.exit_status
         result = chan.recv(1000000)
@@ -40,35 +72,204 @@ class Tar(BootstrapType):
         if not os.path.exists(tarfile):
             raise BootstrapTarError, "Can not find the given file: {0}.".format(tarfile)
 
-    def execute(self, client, stage_number):
+    def execute(self, client, stage_number, deadline=None):
         """
-        Move the tar file into place, unpack and run bootstrap.sh passing any given arguments.
+        Move the tar file into place, unpack and run bootstrap.sh passing any given arguments. deadline is
+        an absolute time after which any command that is still running gets killed.
         """
         sftp = SFTPClient.from_transport(client.get_transport())
         stage_directory = 'stage-' + str(stage_number)
+        # Every SFTP request waits on the channel so keep its timeout in line with the deadline.
+        def bound(*_):
+            sftp.get_channel().settimeout(self.remaining(deadline, self.tarfile))
+
         try:
-            sftp.mkdir(stage_directory)
-        except:
-            logger.exception('')
-        sftp.chdir(stage_directory)
+            bound()
+            try:
+                sftp.mkdir(stage_directory)
+            except IOError:
+                logger.exception('')
+            sftp.chdir(stage_directory)
 
-        # Stage complete so nothing to do.
-        if 'stage-complete' in sftp.listdir():
-            return
+            # Stage complete so nothing to do.
+            if 'stage-complete' in sftp.listdir():
+                return
+
+            # upload, untar, execute bootstrap.sh
+            sftp.put(self.tarfile, '{0}/{1}.tar'.format(sftp.getcwd(), stage_directory),
+                callback=bound)
+        except socket.timeout:
+            raise BootstrapTimeoutError, "Upload did not finish before the deadline: {0}.".format(self.tarfile)
+        finally:
+            sftp.close()
 
-        # upload, untar, execute bootstrap.sh
-        sftp.put(self.tarfile, '{0}/{1}.tar'.format(sftp.getcwd(), stage_directory))
         untar = 'cd {0} && tar xf {1}.tar'.format(stage_directory, stage_directory)
-        untar_result = self.execute_command(untar, client)
+        untar_result = self.execute_command(untar, client, deadline)
         logger.debug('Command results: {0}.'.format(untar_result))
 
+        self._run_bootstrap(client, stage_number, deadline)
+
+    def _run_bootstrap(self, client, stage_number, deadline=None):
+        """
+        Run bootstrap.sh from the already unpacked stage directory and mark the stage complete if it succeeds.
+        """
+        stage_directory = 'stage-' + str(stage_number)
         logger.info('Executing contents of tar file: {0}.'.format(self.tarfile))
         bootstrap_arguments = ' '.join(self.args)
         run_bootstrap = 'cd {0} '.format(
             stage_directory) + '&& sudo -u root -H bash -l -c "bash bootstrap.sh {0}" > output '.format(
             bootstrap_arguments) + '&& touch stage-complete'
-        bootstrap_result = self.execute_command(run_bootstrap, client)
+        bootstrap_result = self.execute_command(run_bootstrap, client, deadline)
         if bootstrap_result[1] != 0:
             logger.error("Stage did not complete: {0}.".format(stage_number))
 
-        logger.debug('Command results: {0}.'.format(bootstrap_result[0]))
\ No newline at end of file
+        logger.debug('Command results: {0}.'.format(bootstrap_result[0]))
+
+
+class CompressingChannelWriter(object):
+    """
+    File-like wrapper around a paramiko channel that compresses whatever is written to it before sending it
+    down the channel. tarfile only needs write() when streaming so that is all we provide.
+    """
+
+    def __init__(self, channel, codec, level, deadline=None):
+        self.channel, self.failed, self.deadline = channel, False, deadline
+        if codec == 'gzip':
+            # 16 + MAX_WBITS gets zlib to write the gzip header and trailer that tar expects.
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif codec == 'bzip2':
+            self.compressor = bz2.BZ2Compressor(level)
+        else:
+            self.compressor = None
+
+    def _send(self, data):
+        """
+        Once a send fails we drop everything else, otherwise tarfile tries to flush into the dead channel again
+        when it gets garbage collected.
+        """
+        if self.failed:
+            return
+        try:
+            # sendall blocks for as long as the remote window stays shut so bound every send by the deadline.
+            self.channel.settimeout(BootstrapType.remaining(self.deadline, 'upload'))
+            self.channel.sendall(data)
+        except:
+            self.failed = True
+            raise
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self._send(data)
+
+    def close(self):
+        """
+        Flush whatever the compressor is holding on to and signal EOF to the remote end.
+        """
+        if self.compressor is not None:
+            self._send(self.compressor.flush())
+        if not self.failed:
+            self.channel.shutdown_write()
+
+
+class StreamingTar(Tar):
+    """
+    Same contract as Tar but instead of copying the tar file over with SFTP and then unpacking it in a separate
+    step the archive is compressed on the fly and streamed straight into tar on the remote end over a single
+    channel, so nothing but the unpacked files gets written to the remote disk. The source can be either a tar
+    file or a directory, in which case the archive is built on the fly without a temporary file. The directory
+    contents end up at the top of the stage directory so bootstrap.sh should live at the root of the directory.
+    Tar files that are already compressed are streamed as is and codec and level are ignored for those.
+    Valid codecs are gzip | bzip2 | none and level is the usual 1-9 compression level, or 0-9 for gzip.
+    """
+
+    # Maps codecs to the flag that tells the remote tar how to decompress its input.
+    CodecFlags = {'gzip': 'z', 'bzip2': 'j', 'none': ''}
+
+    # Compression levels each codec accepts. Anything goes for none since the level is ignored.
+    CodecLevels = {'gzip': range(0, 10), 'bzip2': range(1, 10)}
+
+    # Leading bytes of already compressed tar files and the flag the remote tar needs for them.
+    CompressedFlags = [('\x1f\x8b', 'z'), ('BZh', 'j'), ('\xfd7zXZ\x00', 'J')]
+
+    # How much of a tar file to read at a time when streaming it.
+    ChunkSize = 1024 * 1024
+
+    def __init__(self, source, args, codec='gzip', level=6):
+        super(StreamingTar, self).__init__(source, args)
+        if codec not in self.CodecFlags:
+            raise BootstrapTarError, "Unknown compression codec: {0}.".format(codec)
+        if codec in self.CodecLevels and level not in self.CodecLevels[codec]:
+            raise BootstrapTarError, "Invalid compression level for {0}: {1}.".format(codec, level)
+        self.codec, self.level, self.tar_flag = codec, level, self.CodecFlags[codec]
+
+        # Compressing an already compressed tar file again means the remote tar decompresses one layer, finds no
+        # tar entries and happily exits with 0 having extracted nothing.
+        if os.path.isfile(source):
+            with open(source, 'rb') as archive:
+                magic = archive.read(6)
+            for prefix, flag in self.CompressedFlags:
+                if magic.startswith(prefix):
+                    logger.info('Already compressed so streaming as is: {0}.'.format(source))
+                    self.codec, self.tar_flag = 'none', flag
+                    break
+
+    def _stream_archive(self, writer):
+        if os.path.isdir(self.tarfile):
+            archive = tarfile.open(fileobj=writer, mode='w|')
+            archive.add(self.tarfile, arcname='.')
+            archive.close()
+        else:
+            with open(self.tarfile, 'rb') as source:
+                for chunk in iter(lambda: source.read(self.ChunkSize), ''):
+                    writer.write(chunk)
+        writer.close()
+
+    def stream_command(self, command, client, deadline=None):
+        """
+        Like execute_command() but the archive is fed to the command's stdin. No pty here because with a pty
+        the remote end never sees EOF on stdin. If the remote end gives up early, e.g. bad archive or full disk,
+        the channel gets closed under us so we stop sending and report whatever the command exited with.
+        """
+        logger.info('Streaming {0} into command: {1}.'.format(self.tarfile, command))
+        transport = client.get_transport()
+        transport.set_keepalive(10)
+        chan = transport.open_session()
+        chan.exec_command(command)
+        try:
+            self._stream_archive(CompressingChannelWriter(chan, self.codec, self.level, deadline))
+        except BootstrapTimeoutError:
+            chan.close()
+            raise
+        except socket.timeout:
+            chan.close()
+            raise BootstrapTimeoutError, "Upload did not finish before the deadline: {0}.".format(command)
+        except (socket.error, EOFError):
+            logger.exception('')
+            logger.error('Remote end stopped reading the archive: {0}.'.format(command))
+        self.wait_for_exit(chan, command, deadline)
+
+        exit_status = chan.exit_status
+        result = chan.recv_stderr(1000000)
+        chan.close()
+        return [result, exit_status]
+
+    def execute(self, client, stage_number, deadline=None):
+        """
+        Stream the archive into the stage directory, then run bootstrap.sh passing any given arguments.
+        """
+        stage_directory = 'stage-' + str(stage_number)
+        check = 'mkdir -p {0} && test -f {0}/stage-complete'.format(stage_directory)
+        # Stage complete so nothing to do.
+        if self.execute_command(check, client, deadline)[1] == 0:
+            return
+
+        untar = 'cd {0} && tar x{1}f -'.format(stage_directory, self.tar_flag)
+        untar_result = self.stream_command(untar, client, deadline)
+        logger.debug('Command results: {0}.'.format(untar_result))
+        if untar_result[1] != 0:
+            logger.error("Unable to unpack stage: {0}.".format(stage_number))
+            return
+
+        self._run_bootstrap(client, stage_number, deadline)
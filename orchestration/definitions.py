@@ -2,11 +2,15 @@ import json
 import logging
 import os
 import paramiko
+import socket
+from copy import copy
 from os.path import expanduser
-from time import sleep
+from threading import Event, Lock
+from time import sleep, time
 from paramiko import SSHClient
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
 from boto.ec2.networkinterface import NetworkInterfaceSpecification, NetworkInterfaceCollection
+from orchestration.bootstrap_types import BootstrapTimeoutError
 
 # Logging boilerplate.
 logger = logging.getLogger('definitions')
@@ -72,6 +76,32 @@ def with_retry(retry_message, error_message, retry=10, sleep_time=10):
     return decorator
 
 
+class StragglerPolicy(object):
+    """
+    Deadlines and recovery options for bringing up instances so that one bad EC2 host or one hung bootstrap
+    script can't hold up the whole cluster.
+    """
+
+    def __init__(self, hedge=0, replacements=0, ready_deadline=330, ssh_deadline=660, bootstrap_deadline=None):
+        """
+        The deadlines are in seconds from the start of each phase. ready_deadline is how long an instance has to
+        reach the 'running' state, ssh_deadline is how long it then has to accept SSH connections and
+        bootstrap_deadline is how long the whole bootstrap sequence can take. The defaults for the first two match
+        the old retry counts and there is no bootstrap deadline by default.
+
+        An instance that misses the ready or SSH deadline gets terminated and relaunched under the same name up to
+        replacements times. If it is still not ready after that we log it and carry on like before. A bootstrap
+        sequence that misses its deadline gets killed and logged but the instance is not replaced because by that
+        point its facts and keys have already been handed out to the rest of the cluster.
+
+        hedge only applies to pools. That many extra instances are launched along with the pool and the first
+        pool_size instances that accept SSH connections make up the pool. Everything else is terminated.
+        """
+        self.hedge, self.replacements = hedge, replacements
+        self.ready_deadline, self.ssh_deadline = ready_deadline, ssh_deadline
+        self.bootstrap_deadline = bootstrap_deadline
+
+
 class InstanceDefinition(object):
     """
     Instance specific data and methods, e.g. name, size, security groups, etc.
@@ -88,8 +118,17 @@ class InstanceDefinition(object):
     DriveLetters = 'efghijklmnopqrstuvwxyz'
 
     def __init__(self, name, owner, ami, user, ec2_size, ssh_key, private_key_file, security_groups, subnet,
-        instance_profile_name=None, bootstrap_sequence=None, hostname=None, ebs=None, placement_group=None):
+        instance_profile_name=None, bootstrap_sequence=None, hostname=None, ebs=None, placement_group=None,
+        region=None, profile=None, straggler_policy=None, public_address=False):
+        """
+        region and profile default to the ones the orchestrator was created with. profile picks the credentials
+        file, see Orchestrator for the details. By default we SSH to the private IP address and that is also the
+        ip_address fact. Instances in other regions can't reach those without VPC peering or a VPN so for
+        those clusters set public_address to use the public IP address for both instead.
+        """
         self.name, self.hostname = name, hostname
+        self.region, self.profile, self.public_address = region, profile, public_address
+        self.straggler_policy = straggler_policy or StragglerPolicy()
         self.owner, self.user = owner, user
         self.ami, self.ec2_size = ami, ec2_size
         self.ssh_key, self.placement_group = ssh_key, placement_group
@@ -111,6 +150,10 @@ class InstanceDefinition(object):
         # Variables that will be set when we call various lifecycle methods, e.g. start().
         self.instance, self.ssh_client, self.ebs_optimization = None, None, False
         self.interfaces, self.connection, self.existing_instances = None, None, None
+        # Set when scaling out and this instance is already part of the cluster.
+        self.existing = False
+        # Set when the instance missed its ready or SSH deadline and there were no replacements left.
+        self.unreachable = False
 
     def auto_assign_ip(self):
         """
@@ -137,9 +180,10 @@ class InstanceDefinition(object):
         so that the bootstrap scripts can be aware of the cluster in terms of names, ip addresses, and some other
         basic facts.
         """
-        base_facts = dict(name=self.name, subnet=self.subnet, main_user=self.user, owner=self.owner)
+        base_facts = dict(name=self.name, subnet=self.subnet, main_user=self.user, owner=self.owner,
+            region=self.region)
         try:
-            facts = dict(ip_address=self.instance.private_ip_address, hostname=self.ssh_command('hostname').strip(),
+            facts = dict(ip_address=self.address, hostname=self.ssh_command('hostname').strip(),
                 **base_facts)
         except:
             logger.exception('')
@@ -152,10 +196,10 @@ class InstanceDefinition(object):
     def upload_cluster_facts(self, facts):
         """
         Converts facts to {yaml, json} and upload to /etc/cluster_facts.{yaml, json} so that bootstrap script
-        can use those facts for configuration.
+        can use those facts for configuration. Any existing facts file is overwritten.
         """
         json_facts = json.dumps(facts).replace("'", "\\'").replace('"', '\\"')
-        self.ssh_command("echo {0} | sudo tee -a /etc/cluster_facts.json".format(json_facts))
+        self.ssh_command("echo {0} | sudo tee /etc/cluster_facts.json".format(json_facts))
 
         return self
 
@@ -203,6 +247,99 @@ class InstanceDefinition(object):
 
         return self
 
+    @with_retry("Retrying termination after timeout.", "Unable to terminate instance.", retry=3)
+    def _terminate(self): self.instance.terminate()
+
+    def terminate(self):
+        """
+        Get rid of a straggler or an extra hedge instance.
+        """
+        if self.ssh_client is not None:
+            self.ssh_client.close()
+            self.ssh_client = None
+        if self.instance is not None:
+            logger.info("Terminating instance: {0} - {1}.".format(self.name, self.instance.id))
+            self._terminate()
+
+        return self
+
+    def attach(self, connection, instance):
+        """
+        Use an EC2 instance that is already running instead of starting a new one. Used when scaling out
+        an existing cluster.
+        """
+        self.connection, self.instance, self.existing = connection, instance, True
+        logger.info("Attached to existing instance: {0} - {1}.".format(self.name, instance.id))
+
+        return self
+
+    def replacement(self):
+        """
+        A fresh copy of this definition with the same name and settings that hasn't been started yet.
+        """
+        replacement = copy(self)
+        replacement.instance, replacement.ssh_client, replacement.connection = None, None, None
+
+        return replacement
+
+    def rename(self, name):
+        """
+        Hedge instances get renamed into the pool slot they end up filling.
+        """
+        logger.info("Renaming instance: {0} -> {1}.".format(self.name, name))
+        self.name = name
+        if self.instance is not None:
+            self._add_tags()
+
+        return self
+
+    def wait_until_running(self, deadline, stop=None):
+        """
+        Poll the instance state until it is 'running'. Returns False if we go past the deadline or if stop gets
+        set because somebody else no longer needs this instance.
+        """
+        if self.instance is None:
+            return False
+
+        while time() < deadline and not (stop is not None and stop.is_set()):
+            if self.state == 'running':
+                return True
+            sleep(10)
+
+        return False
+
+    def ssh_banner(self):
+        """
+        Cheap check for a listening SSH server that doesn't do a key exchange. We just read the version banner.
+        """
+        connection = socket.create_connection((self.address, 22), timeout=10)
+        try:
+            return connection.recv(256).startswith('SSH-')
+        finally:
+            connection.close()
+
+    def wait_for_ssh(self, deadline, stop=None, handshake=True):
+        """
+        Same as wait_until_running() but for SSH access. On success the SSH client is left connected. Without
+        handshake we only wait for the SSH banner and leave the connecting to whoever ends up owning the session.
+        """
+        while time() < deadline and not (stop is not None and stop.is_set()):
+            try:
+                if not handshake:
+                    if self.ssh_banner():
+                        return True
+                    raise SSHConnectionError, "No SSH banner: {0}.".format(self.name)
+                self.instantiate_ssh_client()
+                return True
+            except:
+                logger.debug("SSH not available yet: {0}.".format(self.name))
+                if self.ssh_client is not None:
+                    self.ssh_client.close()
+                    self.ssh_client = None
+            sleep(10)
+
+        return False
+
     @with_retry("Retrying to tag EBS volume after timeout.", "Unable to add tags to EBS volume.")
     def _tag_volume(self, volume): volume.add_tag('Name', self.name)
 
@@ -230,6 +367,13 @@ class InstanceDefinition(object):
             self._tag_volume(volume)
             volume.attach(self.instance.id, '/dev/sd{0}'.format(self.DriveLetters[self.ephemeral_device_count + i]))
 
+    @property
+    def address(self):
+        """
+        The IP address we SSH to and hand out in the cluster facts.
+        """
+        return self.instance.ip_address if self.public_address else self.instance.private_ip_address
+
     @property
     def state(self):
         """
@@ -247,7 +391,7 @@ class InstanceDefinition(object):
         """
         self.ssh_client = SSHClient()
         self.ssh_client.set_missing_host_key_policy(AutoIgnorePolicy())
-        self.ssh_client.connect(hostname=self.instance.private_ip_address, username=self.user, timeout=10,
+        self.ssh_client.connect(hostname=self.address, username=self.user, timeout=10,
             key_filename=self.private_key_file)
 
         return self
@@ -255,10 +399,18 @@ class InstanceDefinition(object):
     @with_retry("Retrying SSH connection after timeout.", "SSH connection error.", sleep_time=60)
     def establish_ssh_connection(self):
         """
-        See if we can connect and give up after X number of retries.
+        See if we can connect and give up after X number of retries. Nothing to do if we are already connected.
+        If the instance already missed its SSH deadline we don't wait all over again.
         """
-        private_ip_address, name = self.instance.private_ip_address, self.name
-        logger.info("Establishing SSH connection: {0} - {1}.".format(private_ip_address, name))
+        if self.unreachable:
+            logger.error("Not connecting to instance that missed its deadlines: {0}.".format(self.name))
+            return self
+
+        if self.ssh_client is not None and self.ssh_client.get_transport() is not None and \
+                self.ssh_client.get_transport().is_active():
+            return self
+
+        logger.info("Establishing SSH connection: {0} - {1}.".format(self.address, self.name))
         self.instantiate_ssh_client()
 
         return self
@@ -325,6 +477,22 @@ class InstanceDefinition(object):
         """
         return self.user_pub_key('root')
 
+    def pub_keys(self):
+        """
+        Both the root and the main user keys in one go so that the orchestrator can collect them with a single
+        call per instance.
+        """
+        return [self.root_pub_key, self.user_pub_key(self.user)]
+
+    def authorized_keys(self):
+        """
+        The keys root already accepts. When scaling out we get the keys of the existing instances from one of
+        them instead of asking every single one.
+        """
+        result = self.ssh_command("sudo -u root -H -i bash -c 'cat ~/.ssh/authorized_keys'")
+
+        return [line.strip() for line in result.splitlines() if line.strip().startswith('ssh-')]
+
     def add_pub_keys(self, keys):
         """
         Once we have all the keys, bogus or otherwise, we distribute them with this method. Keys are handed to us
@@ -341,8 +509,16 @@ class InstanceDefinition(object):
         scripts. Most bootstrap scripts depend on knowing cluster facts and having remote root ssh access to other
         nodes in the cluster. Bootstrap script errors will happen if bogus keys get distributed.
         """
-        for i in range(0, len(self.bootstrap_sequence)):
-            self.bootstrap_sequence[i].execute(self.ssh_client, i)
+        deadline = None
+        if self.straggler_policy.bootstrap_deadline is not None:
+            deadline = time() + self.straggler_policy.bootstrap_deadline
+
+        try:
+            for i in range(0, len(self.bootstrap_sequence)):
+                self.bootstrap_sequence[i].execute(self.ssh_client, i, deadline)
+        except BootstrapTimeoutError:
+            logger.exception('')
+            logger.fatal("Bootstrap sequence did not finish before the deadline: {0}.".format(self.name))
 
         return self
 
@@ -350,7 +526,8 @@ class InstanceDefinition(object):
 class Pool(object):
     """
     A pool is just a convenient wrapper around a collection of instances that share common settings. The names
-    of the instances in the pool are appended with numbers starting at 0.
+    of the instances in the pool are appended with numbers starting at 0. Hedge instances start out as
+    <pool_name>-hedge<number> and get renamed if they make it into the pool.
     """
 
     class PoolInstancesAccessor(object):
@@ -364,12 +541,15 @@ class Pool(object):
                 return obj._instance_definitions
 
             obj._instance_definitions = []
-            for i in range(0, obj.pool_size):
-                instance_definition = InstanceDefinition(name=obj.pool_name + str(i), ami=obj.ami, owner=obj.owner,
+            names = [obj.pool_name + str(i) for i in range(0, obj.pool_size)]
+            names += ['{0}-hedge{1}'.format(obj.pool_name, i) for i in range(0, obj.straggler_policy.hedge)]
+            for name in names:
+                instance_definition = InstanceDefinition(name=name, ami=obj.ami, owner=obj.owner,
                     ec2_size=obj.instance_size, ssh_key=obj.ssh_key, bootstrap_sequence=obj.bootstrap_sequence,
                     security_groups=obj.security_groups, subnet=obj.subnet, ebs=obj.ebs, user=obj.user,
                     private_key_file=obj.private_key_file, placement_group=obj.placement_group,
-                    instance_profile_name=obj.instance_profile_name)
+                    instance_profile_name=obj.instance_profile_name, region=obj.region, profile=obj.profile,
+                    straggler_policy=obj.straggler_policy, public_address=obj.public_address)
                 obj._instance_definitions.append(instance_definition)
 
             return obj._instance_definitions
@@ -377,8 +557,11 @@ class Pool(object):
     instance_definitions = PoolInstancesAccessor()
 
     def __init__(self, pool_name, owner, ami, user, instance_size, pool_size, ssh_key, private_key_file,
-        security_groups, subnet, placement_group=None, bootstrap_sequence=None, ebs=None, instance_profile_name=None):
+        security_groups, subnet, placement_group=None, bootstrap_sequence=None, ebs=None, instance_profile_name=None,
+        region=None, profile=None, straggler_policy=None, public_address=False):
         self.pool_name, self.owner = pool_name, owner
+        self.region, self.profile, self.public_address = region, profile, public_address
+        self.straggler_policy = straggler_policy or StragglerPolicy()
         self.ami, self.user = ami, user
         self.placement_group, self.instance_profile_name = placement_group, instance_profile_name
         self.instance_size, self.pool_size = instance_size, pool_size or 1
@@ -387,6 +570,44 @@ class Pool(object):
         self.security_groups, self.subnet = security_groups, subnet
         self.ebs = ebs or []
         self._instance_definitions = None
+        # Bookkeeping for picking the first pool_size instances that come up.
+        self._ready, self._ready_lock, self.full = [], Lock(), Event()
+
+    def claim(self, instance):
+        """
+        Called when an instance is ready to go. Returns False if the pool already has enough instances, in
+        which case the instance is an extra.
+        """
+        with self._ready_lock:
+            if self.full.is_set():
+                return False
+            self._ready.append(instance)
+            if len(self._ready) >= self.pool_size:
+                self.full.set()
+
+            return True
+
+    def select(self, candidates):
+        """
+        Once everything has come up, or given up, settle on the pool members. Instances that claimed a slot go
+        first and if there aren't enough of those we keep the unready ones in launch order like we always have.
+        The rest are terminated. Members that aren't already named after a slot get renamed into a free slot so
+        that the names are always <pool_name>0 through <pool_name><pool_size - 1>.
+        """
+        members = self._ready + [instance for instance in candidates if instance not in self._ready]
+        members, extras = members[:self.pool_size], members[self.pool_size:]
+        for instance in extras:
+            instance.terminate()
+
+        slots = [self.pool_name + str(i) for i in range(0, self.pool_size)]
+        free_slots = [slot for slot in slots if slot not in [instance.name for instance in members]]
+        for instance in members:
+            if instance.name not in slots:
+                instance.rename(free_slots.pop(0))
+
+        self._instance_definitions = sorted(members, key=lambda instance: slots.index(instance.name))
+
+        return self._instance_definitions
 
     def __getattr__(self, item):
         """
@@ -2,17 +2,18 @@ import json
 import os
 import logging
 from os.path import expanduser
-from threading import Thread
-from time import sleep
+from threading import Lock, Thread
+from time import time
 from boto.ec2 import connect_to_region
 from orchestration.definitions import Pool, InstanceDefinition
+from orchestration.shards import ShardPool
 
 # Logging boilerplate.
 logger = logging.getLogger('orchestrator')
 
 # Dynamically create the exception classes.
 for error_class in ['SecretsFileError', 'PreflightError', 'UnknownInstanceDefinitionMethod',
-    'PoolTypeError', 'InstanceTypeError']:
+    'PoolTypeError', 'InstanceTypeError', 'ClusterFactsError']:
     globals()[error_class] = type(error_class, (Exception,), {})
 
 class Orchestrator(object):
@@ -42,21 +43,50 @@ class Orchestrator(object):
 
     all_instances = AllInstanceAccessor()
 
-    def __init__(self, aws_region):
-        self._aws_region = aws_region
-        # Read the secrets from ~/.orchestrator: line 1 = access key, line 2 = secret access key
-        orchestrator_file = expanduser('~/.orchestrator')
-        if os.path.isfile(orchestrator_file):
-            with open(orchestrator_file) as secrets:
-                self._access_key = secrets.readline().strip()
-                self._secret_key = secrets.readline().strip()
-        else:
-            raise SecretsFileError, "Could not open {0} for reading access/secret key.".format(orchestrator_file)
+    def __init__(self, aws_region, processes=None, profile=None, scale_out=False):
+        """
+        By default all the SSH work happens on threads in this process. With enough instances paramiko keeps
+        a single core busy so passing processes spreads the instances across that many worker processes instead.
+
+        aws_region and profile are the defaults for instances and pools that don't specify their own. Instances
+        can be spread across any number of regions and accounts and each (region, profile) pair gets its own
+        connection.
 
+        With scale_out the orchestrator attaches to the cluster described by ~/.cluster_facts.json from a previous
+        run. Instances that already exist are found by their tags and left alone apart from receiving the keys of
+        the new instances and the updated cluster facts. Only the new instances are launched and bootstrapped.
+        """
+        self._aws_region, self._processes, self._profile = aws_region, processes, profile
+        self._scale_out = scale_out
         self._instances, self._pools = [], []
-        self._cluster_facts, self._all_instances = None, None
-        self._connection = connect_to_region(aws_region, aws_access_key_id=self._access_key,
-            aws_secret_access_key=self._secret_key)
+        self._cluster_facts, self._all_instances, self._shards = None, None, None
+        self._connections, self._connections_lock = {}, Lock()
+
+    @staticmethod
+    def _read_secrets(profile):
+        """
+        Read the secrets from ~/.orchestrator or ~/.orchestrator-<profile> for a named profile:
+        line 1 = access key, line 2 = secret access key
+        """
+        orchestrator_file = expanduser('~/.orchestrator' + ('-' + profile if profile else ''))
+        if not os.path.isfile(orchestrator_file):
+            raise SecretsFileError, "Could not open {0} for reading access/secret key.".format(orchestrator_file)
+
+        with open(orchestrator_file) as secrets:
+            return secrets.readline().strip(), secrets.readline().strip()
+
+    def _connection_for(self, region, profile):
+        """
+        Connections are cached per (region, profile) so that all the instances in a region share one.
+        """
+        with self._connections_lock:
+            key = (region, profile)
+            if key not in self._connections:
+                access_key, secret_key = self._read_secrets(profile)
+                self._connections[key] = connect_to_region(region, aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key)
+
+            return self._connections[key]
 
     def add_pool(self, *args, **kwargs):
         """
@@ -75,22 +105,83 @@ class Orchestrator(object):
         self._instances.append(definition)
         return definition
 
-    def _wait_for_ready(self, timeout, retries):
+    def _regions(self):
         """
-        Wait until all instances are in 'running' state. Give up after a set number of retries.
+        Group the instances by (region, profile).
         """
-        retry_count = 0
-        while not all([instance.state == "running" for instance in self.all_instances]):
-            retry_count += 1
-            logger.info("Not all instances are ready. Retrying after {0}s.".format(timeout))
-            sleep(timeout)
-            if retry_count > retries:
-                logger.fatal("Some instances did not transition to 'running' state.")
+        regions = {}
+        for instance in self.all_instances:
+            regions.setdefault((instance.region, instance.profile), []).append(instance)
+
+        return regions
+
+    def _bring_up_member(self, instance, pool, members, index):
+        """
+        Launch a single instance and wait for it to be running and accept SSH connections, replacing it if it
+        misses a deadline and the straggler policy allows it. For pools we stop as soon as the pool has enough
+        instances. Whatever we end up with goes into members[index]. When sharding the SSH sessions belong to
+        the workers so we only check for the SSH banner instead of doing a key exchange here as well.
+        """
+        policy, stop = instance.straggler_policy, pool.full if pool is not None else None
+        replacements = 0
+        while True:
+            if stop is not None and stop.is_set():
+                logger.info("Pool already has enough instances: {0}.".format(instance.name))
+                break
+
+            if instance.instance is None:
+                try:
+                    instance.start(self._connection_for(instance.region, instance.profile))
+                except:
+                    logger.exception('')
+                    logger.error("Unable to start instance: {0}.".format(instance.name))
+
+            if not instance.wait_until_running(time() + policy.ready_deadline, stop):
+                phase = 'transition to running state'
+            elif not instance.wait_for_ssh(time() + policy.ssh_deadline, stop, handshake=not self._processes):
+                phase = 'accept SSH connections'
+            elif pool is None or pool.claim(instance):
+                logger.info("Instance is ready: {0}.".format(instance.name))
+                break
+            else:
+                continue
+
+            # Not a straggler if we only gave up waiting because the pool filled up.
+            if stop is not None and stop.is_set():
+                continue
+            logger.error("Instance did not {0} in time: {1}.".format(phase, instance.name))
+            if replacements >= policy.replacements:
+                logger.fatal("Instance is not ready and there are no replacements left: {0}.".format(instance.name))
+                instance.unreachable = True
                 break
 
-        not_running = [instance for instance in self.all_instances if not instance.state == 'running']
-        for instance in not_running:
-            logger.fatal("Instance did not transition to running state: instance name = {0}.", instance.name)
+            replacements += 1
+            logger.warning("Replacing straggler: {0} ({1}/{2}).".format(instance.name, replacements,
+                policy.replacements))
+            instance.terminate()
+            instance = instance.replacement()
+
+        members[index] = instance
+
+    def _bring_up(self):
+        """
+        Spin up the instances and wait for them to be ready. Every instance is handled on its own thread, across
+        all the regions, so stragglers only hold up themselves. Afterwards the pools pick their members and we
+        swap in any replacements. Existing instances keep their pool slots and are otherwise left alone.
+        """
+        work = [(pool, list(pool.instance_definitions)) for pool in self._pools] + [(None, self._instances)]
+        for pool, members in work:
+            for instance in members:
+                if instance.existing and pool is not None:
+                    pool.claim(instance)
+
+        self._start_threads_and_wait([Thread(target=self._bring_up_member, args=(instance, pool, members, i)) for
+            pool, members in work for i, instance in enumerate(members) if not instance.existing])
+
+        for pool, members in work:
+            if pool is not None:
+                pool.select(members)
+        self._all_instances = None
 
     @staticmethod
     def _start_threads_and_wait(threads):
@@ -99,63 +190,127 @@ class Orchestrator(object):
 
     def _instance_init(self):
         """
-        Instance accessor is lazy so force it to initialize the instances.
+        Instance accessor is lazy so force it to initialize the instances. Anything that doesn't say which
+        region or profile it belongs to gets the orchestrator defaults.
         """
         for x in self.all_instances:
-            logger.info('Found instance definition: {0}.'.format(x.name))
+            x.region, x.profile = x.region or self._aws_region, x.profile or self._profile
+            logger.info('Found instance definition: {0} ({1}).'.format(x.name, x.region))
 
-    def __getattr__(self, item):
+    def _map(self, method, args=(), names=None):
         """
-        Some methods go directly to the underlying instances so just factor out the functionality with
-        __getattr__(). What gets left is the stuff that the orchestrator should truly worry about, i.e.
-        cluster level orchestration.
+        Run the given method on all instances, or only the named ones, and return a dictionary of instance name
+        to result. This happens on the shards if they are running and on threads in this process otherwise. Per
+        instance work goes through here so that what gets left is the stuff that the orchestrator should truly
+        worry about, i.e. cluster level orchestration.
         """
-        if item not in ['_attach_ebs_devices', '_establish_ssh_connection', '_run_bootstrap_sequence',
-            '_generate_ssh_keys']:
+        if not callable(getattr(InstanceDefinition, method, None)):
             raise UnknownInstanceDefinitionMethod, \
-                "Can not use the given method on all instance definitions: {0}.".format(item)
+                "Can not use the given method on all instance definitions: {0}.".format(method)
 
-        def delegator():
-            self._start_threads_and_wait(
-                [Thread(target=getattr(instance, item[1:])) for instance in self.all_instances])
+        if self._shards is not None:
+            return self._shards.map(method, args, names)
 
-        # Cache the method
-        setattr(self, item, delegator)
+        results = {}
 
-        return delegator
+        def call(instance):
+            results[instance.name] = getattr(instance, method)(*args)
 
-    def _start(self):
+        self._start_threads_and_wait([Thread(target=call, args=(instance,)) for instance in self.all_instances if
+            names is None or instance.name in names])
+
+        return results
+
+    def _start_shards(self):
         """
-        Spin up the instances.
+        Fork the worker processes that will own the SSH sessions. Nothing to do if we are not sharding.
         """
-        spin_up_threads = [Thread(target=instance.start, args=(self._connection,)) for
-            instance in self.all_instances]
-        self._start_threads_and_wait(spin_up_threads)
+        if self._processes:
+            self._shards = ShardPool(self.all_instances, self._processes).start()
+
+    def _stop_shards(self):
+        if self._shards is not None:
+            self._shards.stop()
+            self._shards = None
+
+    def _attach_existing(self):
+        """
+        Load the facts from a previous run and attach every instance definition that is named in there to the
+        running EC2 instance with the same Name and Owner tags. One lookup per region. EC2 only takes 200 values
+        per filter so we filter on the owners, of which there are only a handful, and match the names here.
+        """
+        facts_file = expanduser('~/.cluster_facts.json')
+        if not os.path.isfile(facts_file):
+            raise ClusterFactsError, "Can not scale out without the facts from a previous run: {0}.".format(facts_file)
+
+        with open(facts_file) as facts:
+            self._cluster_facts = json.load(facts)
+
+        for (region, profile), instances in self._regions().items():
+            names = [instance.name for instance in instances if instance.name in self._cluster_facts]
+            if not names:
+                continue
+
+            connection = self._connection_for(region, profile)
+            owners = list(set(instance.owner for instance in instances if instance.name in names))
+            reservations = connection.get_all_instances(filters={'tag:Owner': owners,
+                'instance-state-name': 'running'})
+            running = dict(((ec2_instance.tags.get('Name'), ec2_instance.tags.get('Owner')), ec2_instance) for
+                reservation in reservations for ec2_instance in reservation.instances)
+            for instance in instances:
+                ec2_instance = running.get((instance.name, instance.owner))
+                if ec2_instance is not None and instance.name in names:
+                    instance.attach(connection, ec2_instance)
+                elif instance.name in names:
+                    logger.error("No running instance for {0} so launching a new one.".format(instance.name))
+
+        defined = [instance.name for instance in self.all_instances]
+        for name in self._cluster_facts:
+            if name not in defined:
+                logger.error("Not defined so won't get the new keys and facts: {0}.".format(name))
+
+    def _new_and_existing(self):
+        """
+        Names of the instances we launched this time around and of the ones that were already there.
+        """
+        new = [instance.name for instance in self.all_instances if not instance.existing]
+        existing = [instance.name for instance in self.all_instances if instance.existing]
+
+        return new, existing
 
     def _distribute_ssh_keys(self):
         """
-        Take all the root and user keys and append to root authorized_keys.
+        Take all the root and user keys of the new instances and append to root authorized_keys everywhere. The
+        new instances also need the keys the existing instances already accept and any existing instance has all
+        of those so we only ask one of them.
         """
-        all_root_pub_keys = [instance.root_pub_key for instance in self.all_instances]
-        all_user_pub_keys = [instance.user_pub_key(instance.user) for instance in self.all_instances]
-        all_keys = all_root_pub_keys + all_user_pub_keys
-        distribute_ssh_key_threads = [Thread(target=instance.add_pub_keys, args=(all_keys,)) for
-            instance in self.all_instances]
-        self._start_threads_and_wait(distribute_ssh_key_threads)
+        new, existing = self._new_and_existing()
+        new_keys = [key for keys in self._map('pub_keys', names=new).values() for key in keys]
+        existing_keys = []
+        for name in existing:
+            existing_keys = self._map('authorized_keys', names=[name]).get(name)
+            if existing_keys:
+                break
+
+        if existing and not existing_keys:
+            logger.fatal("Unable to get the authorized keys from any existing instance so the new instances won't " +
+                         "have SSH access to the rest of the cluster.")
+
+        self._map('add_pub_keys', (new_keys,), names=existing)
+        self._map('add_pub_keys', ([key for key in existing_keys or [] if key not in new_keys] + new_keys,),
+            names=new)
 
     def _upload_cluster_facts(self):
         """
-        Collect information from each instance and upload the aggregate set to all the nodes.
+        Collect information from each new instance and upload the aggregate set, including the facts we
+        already have for the existing instances, to all the nodes. The existing nodes get the whole set rather than
+        having the new facts merged in on their end because that would need something like python on every image.
         """
-        facts = {}
-        for instance in self.all_instances:
-            facts[instance.name] = instance.instance_facts()
-
+        new, _ = self._new_and_existing()
+        facts = dict(self._cluster_facts or {})
+        facts.update(self._map('instance_facts', names=new))
         self._cluster_facts = facts
-
-        fact_upload_threads = [Thread(target=instance.upload_cluster_facts, args=(facts,)) for
-            instance in self.all_instances]
-        self._start_threads_and_wait(fact_upload_threads)
+        self._map('upload_cluster_facts', (facts,))
 
     def _write_cluster_facts(self):
         """
@@ -178,9 +333,11 @@ class Orchestrator(object):
 
     def _preflight_checks(self):
         """
-        Verify that everything is peachy.
+        Verify that everything is peachy. Opening the connections for every region up front means a missing
+        secrets file shows up before anything gets launched.
         """
-        pass
+        for region, profile in self._regions():
+            self._connection_for(region, profile)
 
     def _go(self):
         """
@@ -188,21 +345,27 @@ class Orchestrator(object):
         """
         self._instance_init()
         self._preflight_checks()
-        logger.info("Spinning up instances.")
-        self._start()
-        logger.info("Waiting for instances to be ready.")
-        self._wait_for_ready(30, 10)
+        if self._scale_out:
+            logger.info("Attaching to existing instances.")
+            self._attach_existing()
+        logger.info("Spinning up instances and waiting for them to be ready.")
+        self._bring_up()
+        new, _ = self._new_and_existing()
         logger.info("Attaching any block devices.")
-        self._attach_ebs_devices()
-        logger.info("Waiting for SSH access.")
-        self._establish_ssh_connection()
-        logger.info("Generating SSH keys.")
-        self._generate_ssh_keys()
-        logger.info("Distributing SSH keys.")
-        self._distribute_ssh_keys()
-        logger.info("Uploading cluster facts.")
-        self._upload_cluster_facts()
-        logger.info("Writing cluster facts to local host as well: ~/.cluster_facts.json.")
-        self._write_cluster_facts()
-        logger.info("Running bootstrap sequence.")
-        self._run_bootstrap_sequence()
+        self._map('attach_ebs_devices', names=new)
+        self._start_shards()
+        try:
+            logger.info("Waiting for SSH access.")
+            self._map('establish_ssh_connection')
+            logger.info("Generating SSH keys.")
+            self._map('generate_ssh_keys', names=new)
+            logger.info("Distributing SSH keys.")
+            self._distribute_ssh_keys()
+            logger.info("Uploading cluster facts.")
+            self._upload_cluster_facts()
+            logger.info("Writing cluster facts to local host as well: ~/.cluster_facts.json.")
+            self._write_cluster_facts()
+            logger.info("Running bootstrap sequence.")
+            self._map('run_bootstrap_sequence', names=new)
+        finally:
+            self._stop_shards()
@@ -0,0 +1,151 @@
+import logging
+from multiprocessing import Process, Queue
+from Queue import Empty
+from threading import Thread
+
+# Logging boilerplate.
+logger = logging.getLogger('shards')
+
+# Dynamically create the exception classes.
+for error_class in ['ShardPoolStartedError', 'ShardPoolStoppedError']:
+    globals()[error_class] = type(error_class, (Exception,), {})
+
+
+def _shard_worker(instances, commands, results):
+    """
+    Main loop of a worker process. The worker owns the SSH sessions for its shard of instances and runs whatever
+    instance method the parent asks for on every instance in the shard with one thread per instance, just like the
+    orchestrator does when it is not sharding. Each instance reports back as soon as it is done so that the parent
+    can log progress and does not have to wait for the slowest instance in a shard to hear about the rest.
+    """
+    by_name = dict((instance.name, instance) for instance in instances)
+
+    def call(instance, method, args):
+        try:
+            result = getattr(instance, method)(*args)
+            # Most instance methods return the instance itself for chaining and there is no point in shipping
+            # that back to the parent, which has its own copy.
+            results.put((instance.name, None if result is instance else result, None))
+        except Exception, e:
+            logger.exception('')
+            results.put((instance.name, None, repr(e)))
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        method, args, names = command
+        threads = [Thread(target=call, args=(by_name[name], method, args)) for name in names]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+    for instance in instances:
+        if instance.ssh_client is not None:
+            instance.ssh_client.close()
+
+
+class Shard(object):
+    """
+    A worker process along with its command queue and the names of the instances it is responsible for.
+    """
+
+    def __init__(self, instances, results):
+        self.names = [instance.name for instance in instances]
+        self.commands = Queue()
+        self.process = Process(target=_shard_worker, args=(instances, self.commands, results))
+        self.process.daemon = True
+
+
+class ShardPool(object):
+    """
+    Paramiko does the key exchange, ciphers and MACs in python so with enough hosts the SSH work alone pins the
+    core the orchestrator runs on. The shard pool spreads the instances across a set of worker processes, each one
+    owning the SSH sessions for its shard. The orchestrator still coordinates the cluster wide steps, e.g. key and
+    fact aggregation, by calling map() for one phase at a time and combining the results itself.
+
+    The workers are forked so the instance definitions are inherited as is. This means the pool should be started
+    after the EC2 work is done and before any SSH connections are opened in the parent.
+    """
+
+    # How long to block on the results queue before checking that the workers are still alive.
+    PollInterval = 5
+
+    def __init__(self, instances, processes):
+        self._instances = instances
+        self._processes = max(1, min(processes, len(instances)))
+        self._results, self._shards, self._started = Queue(), [], False
+
+    def start(self):
+        if self._started:
+            raise ShardPoolStartedError, "Can not call start twice on a single shard pool."
+
+        self._started = True
+        for i in range(0, self._processes):
+            shard = Shard(self._instances[i::self._processes], self._results)
+            self._shards.append(shard)
+            shard.process.start()
+            logger.info("Started shard {0} with {1} instances.".format(i, len(shard.names)))
+
+        return self
+
+    def map(self, method, args=(), names=None):
+        """
+        Run the given instance method on every instance, or only the named ones, across all the shards and
+        return a dictionary of instance name to result. Instances that raised an exception or that were on a shard
+        that died are left out of the results, same as a dead thread is when we are not sharding.
+        """
+        if not self._started or not self._shards:
+            raise ShardPoolStoppedError, "Shard pool is not running: {0}.".format(method)
+
+        wanted = set(names) if names is not None else None
+        pending, results = {}, {}
+        for shard in self._shards:
+            shard_names = [name for name in shard.names if wanted is None or name in wanted]
+            if not shard_names:
+                continue
+            if not shard.process.is_alive():
+                logger.fatal("Shard is not running so skipping instances: {0}.".format(', '.join(shard_names)))
+                continue
+            shard.commands.put((method, args, shard_names))
+            pending[shard] = set(shard_names)
+
+        total = sum(len(outstanding) for outstanding in pending.values())
+        completed = 0
+        while any(pending.values()):
+            try:
+                name, result, error = self._results.get(timeout=self.PollInterval)
+            except Empty:
+                for shard, outstanding in pending.items():
+                    if outstanding and not shard.process.is_alive():
+                        logger.fatal("Shard died while running {0}: {1}.".format(method, ', '.join(outstanding)))
+                        outstanding.clear()
+                continue
+
+            for outstanding in pending.values():
+                outstanding.discard(name)
+            completed += 1
+            if error is None:
+                results[name] = result
+                logger.info("Finished {0}: instance = {1} ({2}/{3}).".format(method, name, completed, total))
+            else:
+                logger.error("Failed {0}: instance = {1}, error = {2}.".format(method, name, error))
+
+        return results
+
+    def stop(self):
+        """
+        Ask the workers to close their SSH sessions and exit. Anything that doesn't exit in a reasonable
+        amount of time gets terminated.
+        """
+        for shard in self._shards:
+            if shard.process.is_alive():
+                shard.commands.put(None)
+
+        for shard in self._shards:
+            shard.process.join(30)
+            if shard.process.is_alive():
+                logger.error("Terminating shard that did not exit: {0}.".format(', '.join(shard.names)))
+                shard.process.terminate()
+
+        self._shards = []